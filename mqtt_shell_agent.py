@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
+import hashlib
+import hmac
+import io
 import os
 import sys
 import pty
-import select
+import selectors
+import socket
 import subprocess
 import threading
 import signal
 import time
 import paho.mqtt.client as mqtt
-from typing import Optional
+
+try:
+    import lz4.frame as lz4frame  # optional; bulk stdout compression
+except ImportError:
+    lz4frame = None
 
 # ==== CONFIG ====
 _raw_host = os.environ.get("MQTT_HOST")
@@ -22,20 +30,45 @@ USE_TLS     = False           # set False if you're not using TLS
 
 SESSION_ID  = os.environ.get("MQTT_ID")   # identifying string for this machine
 TOPIC_BASE  = f"mqtt-shell/{SESSION_ID}"
-TOPIC_STDIN = TOPIC_BASE + "/stdin"
-TOPIC_STDOUT = TOPIC_BASE + "/stdout"
-TOPIC_STATUS = TOPIC_BASE + "/status"
-TOPIC_AUTH = TOPIC_BASE + "/auth"
+# Interned: these are compared against msg.topic on every inbound message.
+TOPIC_STDIN = sys.intern(TOPIC_BASE + "/stdin")
+TOPIC_STDOUT = sys.intern(TOPIC_BASE + "/stdout")
+TOPIC_STATUS = sys.intern(TOPIC_BASE + "/status")
+TOPIC_AUTH = sys.intern(TOPIC_BASE + "/auth")
 # ==============
 
 client = None
 master_fd = None
 shell_proc = None
-shell_thread: Optional[threading.Thread] = None
+pty_file = None
 authenticated = False
 auth_notice_sent = False
-AGENT_PASSWORD_BYTES = AGENT_PASSWORD.encode("utf-8") if AGENT_PASSWORD else None
-shell_lock = threading.Lock()
+# Store only a SHA-256 of the agent password and compare digests with
+# hmac.compare_digest: constant-time, and oversized junk payloads cost one
+# hash instead of a variable-length compare.
+AGENT_PASSWORD_HASH = (
+    hashlib.sha256(AGENT_PASSWORD.encode("utf-8")).digest() if AGENT_PASSWORD else None
+)
+shutdown_event = threading.Event()
+
+# 64 KiB per read: bulk output (cat, compilers, find) arrives in large
+# bursts, and a bigger buffer means far fewer read+publish round-trips.
+# os.read still returns early with whatever is available, so interactive
+# output is unaffected.
+PTY_BUFSIZE = 65536
+# Cap a single publish; past this we flush and come back for the rest so a
+# long burst cannot delay its own first bytes indefinitely.
+PTY_MAX_BATCH = 262144
+# One buffer reused for every read: readinto fills it in place, so bulk
+# output no longer allocates and frees a fresh bytes object per read.
+_pty_buf = bytearray(PTY_MAX_BATCH)
+_pty_view = memoryview(_pty_buf)
+
+# Input the PTY would not accept yet (slave stopped with ^S, or a slow
+# reader); drained from the event loop when the master fd turns writable.
+# Bounded so a wedged shell cannot grow it without limit.
+pty_pending = bytearray()
+PTY_PENDING_MAX = 1048576
 
 def choose_start_dir():
     """
@@ -66,122 +99,181 @@ def choose_start_dir():
 
 
 def start_shell():
-    """Start a fresh PTY-backed shell after successful auth."""
-    global master_fd, shell_proc, shell_thread
+    """Start the PTY-backed shell for the lifetime of the agent.
 
-    with shell_lock:
-        # Avoid starting multiple shells if auth races
-        if shell_proc and shell_proc.poll() is None:
-            return
+    Spawned once at startup rather than per auth, so cwd, environment, and
+    history survive client disconnects and a reconnect costs no fork+exec.
+    """
+    global master_fd, shell_proc, pty_file
 
-        # Create PTY
-        master_fd, slave_fd = pty.openpty()
-
-        # Spawn default shell
-        shell = os.environ.get("SHELL", "/bin/bash")
-        start_dir, home_for_env = choose_start_dir()
-
-        env = os.environ.copy()
-        env.setdefault("TERM", "xterm-256color")
-        env["HOME"] = home_for_env
-        env.setdefault("PS1", "\\u@\\h:\\w$ ")
-
-        shell_cmd = [shell]
-        if shell.endswith("bash"):
-            # Run as a login shell so colors/prompt are loaded from rc files.
-            shell_cmd.append("-l")
-
-        shell_proc = subprocess.Popen(
-            shell_cmd,
-            stdin=slave_fd,
-            stdout=slave_fd,
-            stderr=slave_fd,
-            close_fds=True,
-            preexec_fn=os.setsid,  # give the shell a session and controlling TTY
-            env=env,
-            cwd=start_dir,
-        )
-        os.close(slave_fd)
-
-        shell_thread = threading.Thread(target=shell_reader, daemon=True)
-        shell_thread.start()
-
-def shell_reader():
-    """Read from PTY and publish to MQTT."""
-    global master_fd, shell_proc, client, shell_thread, authenticated, auth_notice_sent
-
-    bufsize = 1024
-    status_sent = False
+    # No-op if a shell is already running.
+    if shell_proc and shell_proc.poll() is None:
+        return
+
+    # Create PTY
+    master_fd, slave_fd = pty.openpty()
+
+    # Spawn default shell
+    shell = os.environ.get("SHELL", "/bin/bash")
+    start_dir, home_for_env = choose_start_dir()
+
+    env = os.environ.copy()
+    env.setdefault("TERM", "xterm-256color")
+    env["HOME"] = home_for_env
+    env.setdefault("PS1", "\\u@\\h:\\w$ ")
+
+    shell_cmd = [shell]
+    if shell.endswith("bash"):
+        # Run as a login shell so colors/prompt are loaded from rc files.
+        shell_cmd.append("-l")
+
+    shell_proc = subprocess.Popen(
+        shell_cmd,
+        stdin=slave_fd,
+        stdout=slave_fd,
+        stderr=slave_fd,
+        close_fds=True,
+        preexec_fn=os.setsid,  # give the shell a session and controlling TTY
+        env=env,
+        cwd=start_dir,
+    )
+    os.close(slave_fd)
+
+    os.set_blocking(master_fd, False)
+    pty_file = io.FileIO(master_fd, "rb", closefd=False)
+
+def frame_stdout(data):
+    """Frame a stdout payload: b"\\x01" + lz4, or b"\\x00" + raw.
+
+    Terminal output is highly redundant (prompts, ANSI escapes, source
+    code), so bulk bursts typically compress several-fold. Small or
+    incompressible payloads are sent raw; the client switches on the flag
+    byte.
+    """
+    if lz4frame is not None and len(data) >= 512:
+        compressed = lz4frame.compress(data)
+        if len(compressed) < len(data) * 0.95:
+            return b"\x01" + compressed
+    return b"\x00" + data
+
+def drain_pty():
+    """Drain pending PTY output into one publish; handle shell exit inline."""
+    global master_fd, shell_proc, pty_file, authenticated, auth_notice_sent
+
+    # Drain everything the kernel has queued and publish it as one message,
+    # instead of one publish per kernel wakeup.
+    total = 0
+    closed = False
+    while total < PTY_MAX_BATCH:
+        try:
+            n = pty_file.readinto(_pty_view[total:total + PTY_BUFSIZE])
+        except OSError:
+            # EIO from the master side means the shell is gone.
+            closed = True
+            break
+        if n is None:
+            # Non-blocking fd with nothing left (EAGAIN).
+            break
+        if n == 0:
+            closed = True
+            break
+        total += n
+
+    if total:
+        client.publish(TOPIC_STDOUT, frame_stdout(bytes(_pty_view[:total])), qos=0)
+
+    if closed:
+        client.publish(TOPIC_STATUS, b"shell-exited", qos=1)
+        try:
+            os.close(master_fd)
+        except OSError:
+            pass
+        if shell_proc:
+            shell_proc.wait()  # reap; the process is already gone
+        master_fd = None
+        shell_proc = None
+        pty_file = None
+        authenticated = False
+        auth_notice_sent = False
+        pty_pending.clear()
+        shutdown_event.set()
+
+def write_pty(data):
+    """Write input to the PTY without ever blocking the event loop.
+
+    Whatever the kernel will not take right now is spooled into
+    pty_pending and flushed once select reports the fd writable.
+    """
+    if pty_pending:
+        if len(pty_pending) + len(data) <= PTY_PENDING_MAX:
+            pty_pending.extend(data)
+        return
     try:
-        while True:
-            if shell_proc.poll() is not None:
-                # Shell has exited
-                client.publish(TOPIC_STATUS, "shell-exited".encode("utf-8"), qos=1)
-                status_sent = True
-                break
-
-            rlist, _, _ = select.select([master_fd], [], [], 0.1)
-            if master_fd in rlist:
-                try:
-                    data = os.read(master_fd, bufsize)
-                except OSError:
-                    break
+        n = os.write(master_fd, data)
+    except BlockingIOError:
+        n = 0
+    except OSError as e:
+        print("Error writing to PTY:", e, file=sys.stderr)
+        return
+    if n < len(data) and len(data) - n <= PTY_PENDING_MAX:
+        pty_pending.extend(data[n:])
 
-                if not data:
-                    break
+def flush_pty_pending():
+    """Drain spooled input now that the PTY master is writable again."""
+    while pty_pending:
+        try:
+            n = os.write(master_fd, pty_pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            pty_pending.clear()
+            return
+        del pty_pending[:n]
 
-                client.publish(TOPIC_STDOUT, data, qos=0)
-    finally:
-        if not status_sent and client:
-            # Ensure the client hears about the exit even on unexpected break.
-            client.publish(TOPIC_STATUS, "shell-exited".encode("utf-8"), qos=1)
-        with shell_lock:
-            if master_fd is not None:
-                try:
-                    os.close(master_fd)
-                except OSError:
-                    pass
-            master_fd = None
-            shell_proc = None
-            shell_thread = None
-            authenticated = False
-            auth_notice_sent = False
+def on_socket_open(mqttc, userdata, sock):
+    # Disable Nagle so shell output hits the wire immediately instead of
+    # waiting (up to ~40ms) for a delayed ACK.
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass  # e.g. not a TCP socket
 
 def on_connect(mqttc, userdata, flags, reason_code, properties=None):
     print("Connected to broker with code:", reason_code)
     mqttc.subscribe([(TOPIC_STDIN, 0), (TOPIC_AUTH, 1)])
-    mqttc.publish(TOPIC_STATUS, "agent-online".encode("utf-8"), qos=1)
+    mqttc.publish(TOPIC_STATUS, b"agent-online", qos=1)
 
 def on_message(mqttc, userdata, msg):
     global master_fd, shell_proc, authenticated, auth_notice_sent
-    if msg.topic == TOPIC_AUTH:
-        if msg.payload == AGENT_PASSWORD_BYTES:
+    # msg.topic is a property that UTF-8-decodes the raw topic on every
+    # access; fetch it once per message.
+    topic = msg.topic
+    if topic == TOPIC_AUTH:
+        if AGENT_PASSWORD_HASH is not None and hmac.compare_digest(
+            hashlib.sha256(msg.payload).digest(), AGENT_PASSWORD_HASH
+        ):
             authenticated = True
             auth_notice_sent = False
-            mqttc.publish(TOPIC_STATUS, "auth-ok".encode("utf-8"), qos=1)
-            start_shell()
-            # Nudge the PTY so the user sees a prompt even if the shell
-            # started before they connected.
+            mqttc.publish(TOPIC_STATUS, b"auth-ok", qos=1)
+            # The shell is spawned once at startup and survives client
+            # disconnects; just nudge the PTY so the user sees a prompt.
             if master_fd is not None:
                 try:
                     os.write(master_fd, b"\n")
                 except OSError:
                     pass
         else:
-            mqttc.publish(TOPIC_STATUS, "auth-fail".encode("utf-8"), qos=1)
+            mqttc.publish(TOPIC_STATUS, b"auth-fail", qos=1)
         return
 
-    if msg.topic == TOPIC_STDIN and master_fd is not None:
+    if topic == TOPIC_STDIN and master_fd is not None:
         if not authenticated:
             if not auth_notice_sent:
-                mqttc.publish(TOPIC_STATUS, "auth-required".encode("utf-8"), qos=1)
+                mqttc.publish(TOPIC_STATUS, b"auth-required", qos=1)
                 auth_notice_sent = True
             return
-        # Write raw bytes into PTY
-        try:
-            os.write(master_fd, msg.payload)
-        except OSError as e:
-            print("Error writing to PTY:", e, file=sys.stderr)
+        # Write raw bytes into PTY (spooled if the PTY is not accepting)
+        write_pty(msg.payload)
 
 def setup_mqtt():
     global client
@@ -195,6 +287,13 @@ def setup_mqtt():
 
     client = mqtt.Client(**client_kwargs)
 
+    # Don't let QoS-1 status messages waiting on ACKs stall the publish
+    # pipeline; keep it deep enough that bulk stdout never queues behind
+    # the default 20-inflight cap.
+    client.max_inflight_messages_set(1000)
+    client.max_queued_messages_set(0)  # unlimited outgoing queue
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+
     if not BROKER_HOST:
         print("MQTT_HOST is not set or is empty; please configure a broker host.", file=sys.stderr)
         sys.exit(1)
@@ -219,29 +318,115 @@ def setup_mqtt():
 
     client.on_connect = on_connect
     client.on_message = on_message
+    client.on_socket_open = on_socket_open
 
     client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
-    client.loop_start()
+
+def event_loop():
+    """Single-threaded loop multiplexing the MQTT socket and the PTY.
+
+    Everything (paho callbacks, PTY drains) runs on this one thread, so
+    there are no cross-thread handoffs per message and no locks. Paho is
+    pumped manually via loop_read/loop_write/loop_misc. Fds are registered
+    with a selectors.DefaultSelector (epoll on Linux) once and only
+    re-registered when they actually change, instead of rebuilding and
+    copying fd sets into the kernel on every iteration.
+    """
+    sel = selectors.DefaultSelector()
+    reg_sock = None
+    reg_sock_events = 0
+    reg_pty = None
+    reg_pty_events = 0
+
+    while not shutdown_event.is_set():
+        sock = client.socket()
+        if sock is None:
+            # Connection lost; let paho re-establish it.
+            if reg_sock is not None:
+                try:
+                    sel.unregister(reg_sock)
+                except KeyError:
+                    pass
+                reg_sock = None
+            try:
+                client.reconnect()
+            except OSError:
+                time.sleep(1)
+            continue
+
+        sock_events = selectors.EVENT_READ
+        if client.want_write():
+            sock_events |= selectors.EVENT_WRITE
+        if sock is not reg_sock:
+            # New socket after (re)connect.
+            if reg_sock is not None:
+                try:
+                    sel.unregister(reg_sock)
+                except KeyError:
+                    pass
+            sel.register(sock, sock_events, "mqtt")
+            reg_sock, reg_sock_events = sock, sock_events
+        elif sock_events != reg_sock_events:
+            sel.modify(sock, sock_events, "mqtt")
+            reg_sock_events = sock_events
+
+        if master_fd is not None:
+            pty_events = selectors.EVENT_READ
+            if pty_pending:
+                # Only ask for writability while input is spooled.
+                pty_events |= selectors.EVENT_WRITE
+            if reg_pty != master_fd:
+                sel.register(master_fd, pty_events, "pty")
+                reg_pty, reg_pty_events = master_fd, pty_events
+            elif pty_events != reg_pty_events:
+                sel.modify(master_fd, pty_events, "pty")
+                reg_pty_events = pty_events
+        elif reg_pty is not None:
+            # drain_pty closed the fd; drop the stale registration.
+            try:
+                sel.unregister(reg_pty)
+            except (KeyError, OSError):
+                pass
+            reg_pty = None
+
+        try:
+            ready = sel.select(timeout=1.0)
+        except OSError:
+            continue
+
+        pty_readable = False
+        pty_writable = False
+        for key, events in ready:
+            if key.data == "mqtt":
+                if events & selectors.EVENT_READ:
+                    client.loop_read()
+                if events & selectors.EVENT_WRITE:
+                    client.loop_write()
+            elif key.data == "pty":
+                pty_readable = bool(events & selectors.EVENT_READ)
+                pty_writable = bool(events & selectors.EVENT_WRITE)
+        client.loop_misc()
+
+        if pty_writable and master_fd is not None:
+            flush_pty_pending()
+        if pty_readable and master_fd is not None:
+            drain_pty()
 
 def main():
-    signal.signal(signal.SIGINT, signal.SIG_DFL)  # let systemd handle signals normally
+    # Both signals just trip the shutdown event so cleanup runs once below.
+    signal.signal(signal.SIGINT, lambda signum, frame: shutdown_event.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_event.set())
 
     setup_mqtt()
+    start_shell()
 
     try:
-        # Wait for MQTT loop; shells are spawned after auth. This thread just
-        # idles to keep the process alive.
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        pass
+        # Runs until the shell exits or a signal arrives.
+        event_loop()
     finally:
         if shell_proc and shell_proc.poll() is None:
             shell_proc.terminate()
-        if shell_thread and shell_thread.is_alive():
-            shell_thread.join(timeout=1)
         if client:
-            client.loop_stop()
             client.disconnect()
 
 if __name__ == "__main__":
@@ -1,20 +1,34 @@
 #!/usr/bin/env python3
+import io
 import os
 import sys
 import select
+import selectors
+import socket
 import termios
 import tty
-import queue
 import threading
+import time
 import getpass
 import uuid
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+try:
+    import lz4.frame as lz4frame  # optional; matches the agent's compression
+except ImportError:
+    lz4frame = None
 
 # ==== STATIC CONFIG (things you probably won't change often) ====
 # Broker can be overridden by CLI target; start with env default.
 BROKER_HOST = os.environ.get("MQTT_HOST")
 BROKER_PORT = int(os.environ.get("MQTT_PORT", "1883"))
 USE_TLS     = False
+# Nagle-style window for coalescing stdin into one publish (milliseconds).
+# A couple of ms is imperceptible when typing but lets a paste or piped
+# stream land as a handful of big messages instead of hundreds of tiny ones.
+BATCH_WINDOW_S = max(int(os.environ.get("MQTT_SHELL_BATCH_MS", "2")), 0) / 1000.0
 # ================================================================
 
 # These will be set at runtime after parsing the ssh-style target
@@ -25,7 +39,13 @@ MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD") or os.environ.get("MQTT_PASS")
 AGENT_PASSWORD = os.environ.get("MQTT_AGENT_PASSWORD") or os.environ.get("AGENT_PASSWORD")
 
 client = None
-stdout_queue: "queue.Queue[bytes]" = queue.Queue()
+STDOUT_FD = sys.stdout.fileno()
+# MQTT v5 topic alias state for the stdin topic. For a one-byte keystroke
+# the full topic string dwarfs the payload; after the first publish carries
+# topic + alias, later ones send only the 2-byte alias. Allowed only up to
+# the broker's TopicAliasMaximum from CONNACK (0 = not supported).
+stdin_alias_max = 0
+stdin_alias_sent = False
 connected_event = threading.Event()
 auth_ok_event = threading.Event()
 remote_exit_event = threading.Event()
@@ -43,10 +63,11 @@ def build_topics():
     if SESSION_ID is None:
         raise RuntimeError("SESSION_ID not set before building topics")
     TOPIC_BASE   = f"mqtt-shell/{SESSION_ID}"
-    TOPIC_STDIN  = TOPIC_BASE + "/stdin"
-    TOPIC_STDOUT = TOPIC_BASE + "/stdout"
-    TOPIC_STATUS = TOPIC_BASE + "/status"
-    TOPIC_AUTH   = TOPIC_BASE + "/auth"
+    # Interned: compared against msg.topic on every inbound message.
+    TOPIC_STDIN  = sys.intern(TOPIC_BASE + "/stdin")
+    TOPIC_STDOUT = sys.intern(TOPIC_BASE + "/stdout")
+    TOPIC_STATUS = sys.intern(TOPIC_BASE + "/status")
+    TOPIC_AUTH   = sys.intern(TOPIC_BASE + "/auth")
 
 
 def parse_target_arg(argv):
@@ -77,24 +98,63 @@ def parse_target_arg(argv):
 
 
 def on_connect(mqttc, userdata, flags, reason_code, properties=None):
+    global stdin_alias_max, stdin_alias_sent
+    # A refused CONNACK (e.g. bad broker credentials) also lands here;
+    # don't treat it as connected or the failure gets misreported later.
+    # paho 2.x reason codes have is_failure; fall back to the numeric value.
+    failed = getattr(reason_code, "is_failure", None)
+    if failed is None:
+        failed = getattr(reason_code, "value", reason_code) != 0
+    if failed:
+        print(f"[mqtt-shell] Broker refused the connection: {reason_code}.", file=sys.stderr)
+        return
     print(f"[mqtt-shell] Connected to broker (code {reason_code}).", file=sys.stderr)
+    # Aliases are per-connection; re-learn the broker's limit and
+    # re-establish ours on every (re)connect.
+    stdin_alias_max = getattr(properties, "TopicAliasMaximum", 0) if properties else 0
+    stdin_alias_sent = False
     connected_event.set()
     mqttc.subscribe([(TOPIC_STDOUT, 0), (TOPIC_STATUS, 1)])
 
 
+def on_socket_open(mqttc, userdata, sock):
+    # Disable Nagle so single-keystroke publishes hit the wire immediately
+    # instead of waiting (up to ~40ms) for a delayed ACK.
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass  # e.g. not a TCP socket
+
+
 def on_message(mqttc, userdata, msg):
-    if msg.topic == TOPIC_STDOUT:
-        stdout_queue.put(msg.payload)
-    elif msg.topic == TOPIC_STATUS:
-        try:
-            text = msg.payload.decode("utf-8", errors="replace")
-        except Exception:
-            text = repr(msg.payload)
-        print(f"[status] {text}", file=sys.stderr)
-        if text == "auth-ok":
+    # msg.topic is a property that UTF-8-decodes the raw topic on every
+    # access; fetch it once per message.
+    topic = msg.topic
+    if topic == TOPIC_STDOUT:
+        # First byte is the agent's compression flag: 0x01 = lz4, 0x00 = raw.
+        if msg.payload[:1] == b"\x01":
+            if lz4frame is None:
+                print(
+                    "[mqtt-shell] Agent sent lz4-compressed output but the "
+                    "'lz4' package is not installed here; pip install lz4.",
+                    file=sys.stderr,
+                )
+                return
+            data = lz4frame.decompress(msg.payload[1:])
+        else:
+            data = msg.payload[1:]
+        # Write straight from paho's network thread; it is the only writer,
+        # so ordering is preserved and no queue or lock is needed.
+        os.write(STDOUT_FD, data)
+    elif topic == TOPIC_STATUS:
+        # Match on the raw payload; the log line is written as bytes too,
+        # so no decode/encode round-trip happens at all.
+        if msg.payload == b"auth-ok":
             auth_ok_event.set()
-        if text == "shell-exited":
+        elif msg.payload == b"shell-exited":
             remote_exit_event.set()
+        sys.stderr.buffer.write(b"[status] " + msg.payload + b"\n")
+        sys.stderr.buffer.flush()
 
 
 def setup_mqtt():
@@ -112,6 +172,16 @@ def setup_mqtt():
 
     client = mqtt.Client(**client_kwargs)
 
+    # Unlike the agent (which streams bulk stdout), the client sends little
+    # and must stay interactive: keep inflight at the default 20. Note the
+    # queued-messages cap only governs QoS>0 publishes (here, just the auth
+    # message); QoS-0 stdin goes straight to paho's packet queue, so paste
+    # backpressure is applied in the main loop by not draining stdin while
+    # unsent packets remain.
+    client.max_inflight_messages_set(20)
+    client.max_queued_messages_set(1000)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+
     if USERNAME:
         client.username_pw_set(USERNAME, MQTT_PASSWORD)
 
@@ -120,19 +190,51 @@ def setup_mqtt():
 
     client.on_connect = on_connect
     client.on_message = on_message
+    client.on_socket_open = on_socket_open
 
     client.connect(BROKER_HOST, BROKER_PORT, keepalive=60)
-    client.loop_start()
 
 
-def writer_loop():
-    """Pull data from stdout_queue and write to local stdout."""
-    while True:
-        data = stdout_queue.get()
-        if data is None:
-            break
-        os.write(sys.stdout.fileno(), data)
-        sys.stdout.flush()
+def publish_stdin(payload):
+    """Publish stdin, using an MQTT v5 topic alias when the broker allows.
+
+    The first publish after (re)connect carries the full topic plus the
+    alias registration; subsequent ones carry an empty topic and just the
+    alias. Falls back to plain publishes if the broker offered no aliases.
+    """
+    global stdin_alias_max, stdin_alias_sent
+    if stdin_alias_max >= 1:
+        props = Properties(PacketTypes.PUBLISH)
+        props.TopicAlias = 1
+        try:
+            if stdin_alias_sent:
+                # Empty str topic is valid under MQTTv5 when an alias
+                # is attached; paho raises ValueError otherwise.
+                client.publish("", payload, qos=0, properties=props)
+            else:
+                client.publish(TOPIC_STDIN, payload, qos=0, properties=props)
+                stdin_alias_sent = True
+            return
+        except ValueError:
+            # paho rejected the alias form; stop trying.
+            stdin_alias_max = 0
+    client.publish(TOPIC_STDIN, payload, qos=0)
+
+
+def pump_until(event, timeout):
+    """Drive the MQTT loop on this thread until `event` is set.
+
+    With no background network thread, callbacks only fire while we pump;
+    used for the connect/auth handshake before entering the main loop.
+    Returns False on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while not event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        client.loop(timeout=min(remaining, 0.1))
+    return True
 
 
 def main():
@@ -159,50 +261,159 @@ def main():
         MQTT_PASSWORD = getpass.getpass("MQTT broker password: ")
     if not AGENT_PASSWORD:
         AGENT_PASSWORD = getpass.getpass(f"Agent password for {SESSION_ID}: ")
+    # Encode once here; as a rule, no .encode() belongs in a publish path.
+    auth_payload = AGENT_PASSWORD.encode("utf-8")
 
     # Now that SESSION_ID is known, build topics
     build_topics()
 
     setup_mqtt()
 
-    if not connected_event.wait(timeout=5):
+    if not pump_until(connected_event, timeout=5):
         print("Failed to connect to MQTT broker; giving up.", file=sys.stderr)
         sys.exit(1)
 
-    # Authenticate to the remote agent before sending any input
-    client.publish(TOPIC_AUTH, AGENT_PASSWORD.encode("utf-8"), qos=1)
-
-    if not auth_ok_event.wait(timeout=5):
+    # Authenticate to the remote agent before sending any input. Confirm
+    # the publish itself went out before waiting on the agent, so a local
+    # send failure is not misreported as the agent not answering.
+    info = client.publish(TOPIC_AUTH, auth_payload, qos=1)
+    deadline = time.monotonic() + 2
+    while True:
+        try:
+            if info.is_published():
+                break
+        except RuntimeError:
+            # is_published raises while the publish is in a failed state
+            # (e.g. socket down at publish time); keep pumping in case the
+            # queued QoS-1 message still goes out before the deadline.
+            pass
+        if time.monotonic() >= deadline:
+            print("Could not send the auth message to the broker; giving up.", file=sys.stderr)
+            sys.exit(1)
+        client.loop(timeout=0.1)
+
+    if not pump_until(auth_ok_event, timeout=5):
         print("Agent authentication failed or timed out.", file=sys.stderr)
-        client.loop_stop()
         client.disconnect()
+        client.loop(timeout=0.1)  # flush the DISCONNECT
         sys.exit(1)
 
     # Put terminal into raw mode so ^C, arrows, etc. go through as bytes
     fd = sys.stdin.fileno()
     old_settings = termios.tcgetattr(fd)
     tty.setraw(fd)
-
-    writer_thread = threading.Thread(target=writer_loop, daemon=True)
-    writer_thread.start()
+    os.set_blocking(fd, False)
+
+    # One buffer reused for every stdin read; readinto fills it in place so
+    # a paste stream does not allocate a fresh bytes object per read.
+    stdin_buf = bytearray(16384)
+    stdin_view = memoryview(stdin_buf)
+    stdin_file = io.FileIO(fd, "rb", closefd=False)
+
+    # Single-threaded from here on: one selector multiplexes stdin and the
+    # MQTT socket, and paho is pumped inline. on_message runs on this
+    # thread, so there are no cross-thread handoffs per message.
+    sel = selectors.DefaultSelector()
+    reg_sock = None
+    reg_sock_events = 0
+    sel.register(fd, selectors.EVENT_READ, "stdin")
 
     try:
         while True:
             if remote_exit_event.is_set():
                 break
 
-            rlist, _, _ = select.select([fd], [], [], 0.1)
-            if fd in rlist:
-                data = os.read(fd, 1024)
-                if not data:
+            sock = client.socket()
+            if sock is None:
+                # Connection lost; let paho re-establish it.
+                if reg_sock is not None:
+                    try:
+                        sel.unregister(reg_sock)
+                    except KeyError:
+                        pass
+                    reg_sock = None
+                try:
+                    client.reconnect()
+                except OSError:
+                    time.sleep(1)
+                continue
+
+            sock_events = selectors.EVENT_READ
+            if client.want_write():
+                sock_events |= selectors.EVENT_WRITE
+            if sock is not reg_sock:
+                if reg_sock is not None:
+                    try:
+                        sel.unregister(reg_sock)
+                    except KeyError:
+                        pass
+                sel.register(sock, sock_events, "mqtt")
+                reg_sock, reg_sock_events = sock, sock_events
+            elif sock_events != reg_sock_events:
+                sel.modify(sock, sock_events, "mqtt")
+                reg_sock_events = sock_events
+
+            try:
+                ready = sel.select(timeout=1.0)
+            except OSError:
+                continue
+
+            stdin_ready = False
+            for key, events in ready:
+                if key.data == "mqtt":
+                    if events & selectors.EVENT_READ:
+                        client.loop_read()
+                    if events & selectors.EVENT_WRITE:
+                        client.loop_write()
+                else:
+                    stdin_ready = True
+            client.loop_misc()
+
+            if stdin_ready and client.want_write():
+                # Packets from earlier publishes are still unsent: leave
+                # input in the kernel's stdin buffer until the socket
+                # drains. This is the actual bound on a runaway paste —
+                # QoS-0 publishes land in paho's packet queue unchecked, so
+                # we must stop producing, and the terminal absorbs the
+                # pressure the way it would for any slow reader.
+                stdin_ready = False
+
+            if stdin_ready:
+                # Drain whatever is pending (a keystroke, or a whole paste)
+                # and send it as one publish instead of one per read. When
+                # the fd runs dry, linger up to the batch window in case
+                # more of a paste is still arriving.
+                total = 0
+                closed = False
+                deadline = time.monotonic() + BATCH_WINDOW_S
+                while total < 16384:
+                    n = stdin_file.readinto(stdin_view[total:total + 4096])
+                    if n is None:
+                        # Non-blocking fd with nothing buffered (EAGAIN).
+                        if total >= 1024:
+                            break
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        more, _, _ = select.select([fd], [], [], remaining)
+                        if not more:
+                            break
+                        continue
+                    if n == 0:
+                        closed = True
+                        break
+                    total += n
+
+                if total:
+                    publish_stdin(bytes(stdin_view[:total]))
+                if closed:
                     break
-                client.publish(TOPIC_STDIN, data, qos=0)
     finally:
+        os.set_blocking(fd, True)
         termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-        stdout_queue.put(None)
         if client:
-            client.loop_stop()
             client.disconnect()
+            client.loop(timeout=0.1)  # flush the DISCONNECT
 
 
 if __name__ == "__main__":